@@ -1,5 +1,6 @@
 from alsaaudio import *
 from time import sleep
+from pcm_recorder import *
 
 ## This program demonstrates a simplest case example of how to record PC audio playback as PCM data and then
 ## play that audio again manually through code.
@@ -30,39 +31,31 @@ def clear_buffer():
         print('clearing buffer ...')
     print('buffer cleared')
 
-def record(number_of_periods):
+def record(number_of_periods, path='recording.wav'):
+    # Periods are streamed straight into a memory-mapped WAV file (see pcm_recorder.py) rather than kept in a list,
+    # so this works for recordings longer than there is RAM. The returned reader maps the file for instant replay.
     clear_buffer()
-    recording = []
-    for i in range(number_of_periods):
-        recording.append(recording_pcm.read()[1])
-        sleep(0.001) # Not sure why this is a perfect value, but StackOverflow said it would be and it is
-    return recording
-
-def playback(recording):
-    for period in recording:
+    record_to_wav(recording_pcm, path, number_of_periods)
+    return MappedWavReader(path)
+
+def playback(recording, period_size=32):
+    for period in recording.periods(period_size):
         playback_pcm.write(period)
 
 ## Analysis
 
 def unsigned_ints_from_pcm_16b_LR(frames):
     # Using default PCM object settings (16-bit little endian)
-    left = []
-    right = []
-    for i in range(0, len(frames), 4):
-        left_value = int.from_bytes(frames[i:i+2], 'little') # - int(max_int_16b / 2)     # This value may be off by
-        right_value = int.from_bytes(frames[i+2:i+4], 'little') # - int(max_int_16b / 2)  # 0.5, should not matter
-
-        left.append(left_value)
-        right.append(right_value)
-
-    return (left, right)
+    # Returns numpy views striding over the same bytes, nothing is copied
+    return deinterleave(frames, channels=2, dtype='<u2')
 
 def fill_list_with_zero_complex_part(data):
     # FFT expects real and complex pairs that alternate, e.g. [1, 2] would be considered one value with 1 being the real part
     # and 2(i) being the complex part. We have no need for the complex part, so we fill in zeroes.
 
-    for i in range(len(data)):
-        data.insert(i * 2 + 1, 0)
+    interleaved = [0] * (len(data) * 2)
+    interleaved[::2] = data
+    data[:] = interleaved
 
 if __name__ == '__main__':
     recording = record(10240)
@@ -0,0 +1,304 @@
+import asyncio
+import numpy as np
+import os
+import select
+import time
+from rammi_fft import *
+from frame_scheduler import *
+from pcm_recorder import *
+
+## asyncio-native capture. A PCM opened in PCM_NONBLOCK mode is only read when its poll descriptors say there is
+## something to read, so capture, analysis and whatever else (e.g. network publishing) can share one event loop without
+## threads and without spinning on read() or sleep().
+
+class AsyncCaptureSource (object):
+
+    """
+    AsyncCaptureSource turns a PCM_NONBLOCK capture PCM into an async iterator of periods.
+
+    Typical usage:
+
+        recording_pcm = PCM(type=PCM_CAPTURE, mode=PCM_NONBLOCK, device='pulse')
+        async with AsyncCaptureSource(recording_pcm) as source:
+            async for frames, data, timestamp in source:
+                ...
+
+    Anything with polldescriptors() and a nonblocking read() returning (frames, bytes) works in place of the PCM,
+    see SimulatedPCM.
+
+    Each descriptor is watched for the events its mask asks for (POLLIN and/or POLLOUT). ALSA plugins don't always
+    use their descriptors to mean "readable", so when the PCM has polldescriptors_revents() (pyalsaaudio does), every
+    wakeup goes through it first; that also clears the plugin's wakeup, so a descriptor can't keep firing while read()
+    has nothing to return.
+
+    Periods wait in a queue of at most queue_size. When the consumer falls behind, overflow decides what happens:
+
+        * 'drop_oldest'     the oldest queued period makes room for the new one (capture always stays current)
+        * 'pause'           stop reading until there is room again; the device buffer absorbs the backlog, and
+                            overruns once that is full too
+
+    self.periods_dropped counts periods lost either way (including overruns reported by the PCM).
+    """
+
+    def __init__(self, pcm, queue_size=16, overflow='drop_oldest'):
+
+        if overflow not in ('drop_oldest', 'pause'):
+            raise ValueError('AsyncCaptureSource.__init__: overflow ' + str(overflow) + ' is not one of drop_oldest, pause')
+
+        self.pcm = pcm
+        self.queue_size = queue_size
+        self.overflow = overflow
+
+        self.loop = None
+        self.queue = None
+        self.descriptors = []           # (fd, event_mask) from polldescriptors()
+        self.poller = None              # Used to collect revents for polldescriptors_revents, if the PCM has it
+        self.reading = False
+        self.closed = False
+
+        self.periods_captured = 0
+        self.periods_dropped = 0
+
+    def start(self):
+
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.descriptors = list(self.pcm.polldescriptors())
+        self.closed = False
+
+        self.poller = None
+        if hasattr(self.pcm, 'polldescriptors_revents'):
+            self.poller = select.poll()
+            for fd, event_mask in self.descriptors:
+                self.poller.register(fd, event_mask)
+
+        self.resume()
+
+    def resume(self):
+
+        if self.reading or self.closed:
+            return
+
+        for fd, event_mask in self.descriptors:
+            if event_mask & select.POLLIN:
+                self.loop.add_reader(fd, self.on_wakeup)
+            if event_mask & select.POLLOUT:
+                self.loop.add_writer(fd, self.on_wakeup)
+        self.reading = True
+
+        self.on_readable()      # Anything that arrived while paused won't necessarily trigger the descriptors again
+
+    def pause(self):
+
+        if not self.reading:
+            return
+
+        for fd, event_mask in self.descriptors:
+            if event_mask & select.POLLIN:
+                self.loop.remove_reader(fd)
+            if event_mask & select.POLLOUT:
+                self.loop.remove_writer(fd)
+        self.reading = False
+
+    def on_wakeup(self):
+        """ A descriptor fired; ask the PCM what that means before reading """
+
+        if self.poller is not None and not poll_revents(self.pcm, self.poller, self.descriptors) & select.POLLIN:
+            return
+
+        self.on_readable()
+
+    def on_readable(self):
+        """ Drain everything the PCM has ready into the queue """
+
+        while self.reading:
+
+            if self.queue.full() and self.overflow == 'pause':
+                self.pause()
+                return
+
+            frames, data = self.pcm.read()
+            if frames == 0:
+                return
+            if frames < 0:
+                self.periods_dropped += 1     # Overrun; the PCM recovers on the next read
+                continue
+
+            if self.queue.full():
+                # Only now that there is a newer period to take its place
+                self.queue.get_nowait()
+                self.periods_dropped += 1
+
+            self.periods_captured += 1
+            self.queue.put_nowait((frames, data, time.time()))
+
+    def close(self):
+
+        self.pause()
+        self.closed = True
+        if self.queue is not None:
+            if self.queue.full():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)     # Ends iteration once the consumer gets to it
+
+    def drain(self):
+        """ Everything already queued, without waiting """
+
+        periods = []
+        while not self.queue.empty():
+            period = self.queue.get_nowait()
+            if period is None:
+                self.queue.put_nowait(None)     # Leave the end for the async for to see
+                break
+            periods.append(period)
+
+        if not self.reading and not self.closed:
+            self.resume()
+
+        return periods
+
+    def __aiter__(self):
+
+        return self
+
+    async def __anext__(self):
+
+        if self.queue is None:
+            self.start()
+
+        period = await self.queue.get()
+        if period is None:
+            raise StopAsyncIteration
+
+        if not self.reading and not self.closed:
+            self.resume()
+
+        return period
+
+    async def __aenter__(self):
+
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+
+        self.close()
+
+class SimulatedPCM (object):
+
+    """
+    SimulatedPCM stands in for a PCM_NONBLOCK capture PCM (mono, PCM_FORMAT_S16_LE) inside an event loop. Periods of
+    signal(first_sample, count) become readable in real time, scheduled with call_at on the running loop, and are
+    announced through a pipe whose read end is the only poll descriptor. The default signal is a 440 Hz sine.
+    """
+
+    def __init__(self, sample_rate=44100, period_size=64, signal=None):
+
+        self.sample_rate = sample_rate
+        self.period_size = period_size
+        self.signal = signal if signal is not None else (
+            lambda first_sample, count: 0.5 * np.sin(2 * np.pi * 440 * np.arange(first_sample, first_sample + count) / sample_rate))
+
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+
+        self.ready = []             # Periods that have "arrived" but haven't been read
+        self.samples_produced = 0
+        self.start_time = None
+        self.timer = None
+
+    def polldescriptors(self):
+
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.start_time = loop.time()
+            self.schedule(loop)
+
+        return [(self.read_fd, select.POLLIN)]
+
+    def schedule(self, loop):
+
+        self.timer = loop.call_at(self.start_time + (self.samples_produced + self.period_size) / self.sample_rate, self.produce, loop)
+
+    def produce(self, loop):
+
+        samples = self.signal(self.samples_produced, self.period_size)
+        self.samples_produced += self.period_size
+        self.ready.append((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+        os.write(self.write_fd, b'\x00')
+
+        self.schedule(loop)
+
+    def read(self):
+
+        if len(self.ready) == 0:
+            try:
+                os.read(self.read_fd, 4096)     # Nothing left, so stop the descriptor reading as ready
+            except BlockingIOError:
+                pass
+            return (0, b'')
+
+        return (self.period_size, self.ready.pop(0))
+
+    def close(self):
+
+        if self.timer is not None:
+            self.timer.cancel()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+async def feed_rammi_fft(source, ram_ft, decode=normalize_pcm, on_frame=None):
+    """
+    Feed every period from an AsyncCaptureSource into ram_ft. Whatever queued up while the transform ran is taken in
+    one go, so there is one full_transform per batch rather than per period. on_frame(ram_ft) is called (and awaited,
+    if it returns an awaitable) after each transform.
+    """
+
+    async for frames, data, timestamp in source:
+
+        chunks = [data]
+        total_frames = frames
+        for period in source.drain():
+            chunks.append(period[1])
+            total_frames += period[0]
+
+        ram_ft.intake_samples(decode(b''.join(chunks), total_frames))
+        ram_ft.full_transform()
+
+        if on_frame is not None:
+            result = on_frame(ram_ft)
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                await result
+
+if __name__ == '__main__':
+
+    use_simulated = True
+    duration = 5
+
+    async def main():
+
+        if use_simulated:
+            recording_pcm = SimulatedPCM()
+        else:
+            from alsaaudio import PCM, PCM_CAPTURE, PCM_NONBLOCK
+            recording_pcm = PCM(type=PCM_CAPTURE, mode=PCM_NONBLOCK, device='pulse')
+            recording_pcm.setchannels(1)
+            recording_pcm.setperiodsize(64)
+
+        ram_ft = RammiFFT()
+        frames = [0]
+
+        def on_frame(ram_ft):
+            frames[0] += 1
+
+        async with AsyncCaptureSource(recording_pcm) as source:
+            try:
+                await asyncio.wait_for(feed_rammi_fft(source, ram_ft, on_frame=on_frame), duration)
+            except asyncio.TimeoutError:
+                pass
+
+        print('transforms: ' + str(frames[0]) + ', periods captured: ' + str(source.periods_captured) +
+              ', dropped: ' + str(source.periods_dropped))
+        print('loudest band: ' + str(int(np.argmax(ram_ft.frequency_spectrum_raw))))
+
+    asyncio.run(main())
@@ -0,0 +1,298 @@
+import numpy as np
+import math
+import time
+
+def normalize_pcm(pcm_bytes, frames):
+    """ Turn one or more periods of mono PCM_FORMAT_S16_LE bytes into floats in [-2, 2] the same way the visualizers always have """
+
+    processed = np.frombuffer(pcm_bytes, dtype='<u2', count=frames).astype('float64')
+
+    # Normalize to [-1, 1]
+    processed /= 32767.5
+    processed -= 1
+
+    # The PCM results are "inside out" (they are really signed samples read as unsigned), and this corrects it
+    processed = np.where(processed > 0, processed - 1, np.where(processed < 0, processed + 1, 0))
+
+    processed *= 2 # Just some amplification to increase visibility
+
+    return processed
+
+class FrameScheduler (object):
+
+    """
+    FrameScheduler replaces the wall-clock catch-up that the visualizers used to do in read_pcm. Once per displayed frame it
+    drains whatever the capture PCM has buffered, feeds the useful part of it to a RammiFFT and runs the transform, while
+    watching how far behind real time the capture is and how long the transform takes.
+
+    Typical usage:
+
+        scheduler = FrameScheduler(ram_ft, period_size=64, target_latency=0.05)
+        scheduler.start()
+        while True:
+            if scheduler.process(recording_pcm):
+                somehow_display(ram_ft.frequency_spectrum_final)
+
+    The end-to-end latency (newest captured sample to spectrum ready, see estimated_latency()) is the capture backlog
+    found at each read, plus the frames a transform waits for under transform_stride, plus the scheduler's own work
+    (decoding, intake_samples and full_transform). While it is over target_latency, the scheduler works through these
+    steps in order, and back out in reverse order once there is room for the transform to cost twice as much:
+
+        * degrade_level 1       interpolate to ram_ft.frequency_spectrum_size_degraded, half of beautified_size
+        * degrade_level 2       skip interpolation altogether (frequency_spectrum_final is the trimmed spectrum)
+        * transform_stride N    only transform every Nth frame; audio read in between is coalesced into the next transform.
+                                Every step adds a frame interval of staleness and saves at most part of one, so it is
+                                only taken when estimated_latency(N) says latency would actually go down
+
+    Degrading only happens while the scheduler's own work is at least work_fraction of the frame interval. If the
+    render loop alone is what makes frames slow, nothing done here would bring latency back under target.
+
+    The hop size (hop_size, samples fed in per transform) is not throttled separately. It is always all new audio up to
+    time_domain_buffer_size: the FFT is the same size whatever the hop, so feeding less would only make the spectrum
+    staler without making the transform any cheaper.
+
+    Audio that is too old to matter is read and dropped rather than fed through the FFT. It has to be read all the
+    same, or the device would hand it back on every later read and capture would stay that far behind for good. If one
+    of those reads reports an overrun, the device has thrown its buffer away and restarted, so the rest of the backlog
+    is written off.
+
+    Counters, see report():
+
+        * self.periods_dropped      capture periods read and thrown away, or lost to an overrun
+        * self.frames_coalesced     frames whose transform was folded into a later one
+        * self.frames_degraded      frames transformed at degrade_level > 0
+        * self.frames_transformed
+
+    A LatencyProbe (see latency_harness.py) passed as probe gets stamped as samples pass the capture, intake and
+    transform stages.
+    """
+
+    def __init__(self, ram_ft, sample_rate=44100, period_size=64, target_latency=0.05, smoothing=0.2,
+                 recovery_frames=30, max_transform_stride=8, work_fraction=0.5, probe=None):
+
+        self.ram_ft = ram_ft
+        self.probe = probe
+        self.sample_rate = sample_rate
+        self.period_size = period_size
+        self.period_duration = period_size / sample_rate
+
+        self.target_latency = target_latency    # Seconds between the newest sample being captured and its spectrum being ready
+
+        # More periods than fit in the time domain buffer would just be pushed straight back out of it
+        self.max_useful_periods = max(1, int(ram_ft.time_domain_buffer_size / period_size))
+
+        self.smoothing = smoothing                  # Weight of the newest measurement in the moving averages below
+        self.recovery_frames = recovery_frames      # Consecutive comfortable frames needed before stepping load back up
+        self.max_transform_stride = max_transform_stride
+        self.work_fraction = work_fraction          # Share of the frame interval the scheduler's own work must take before degrading
+
+        self.start_time = None
+        self.samples_taken = 0          # Samples accounted for since start(), read or dropped
+
+        self.transform_cost = None      # Moving average of full_transform duration in seconds, at the current degrade level
+        self.capture_cost = None        # Moving average of decode + intake_samples duration per frame
+        self.frame_interval = None      # Moving average of time between process() calls
+        self.backlog = None             # Moving average of how old the oldest unread sample is when read_pcm starts
+        self.last_frame_time = None
+
+        self.degrade_level = 0
+        self.transform_stride = 1
+        self.frames_since_transform = 0
+        self.comfortable_frames = 0
+        self.hop_size = 0               # Samples fed in since the previous transform
+
+        self.periods_dropped = 0
+        self.frames_coalesced = 0
+        self.frames_degraded = 0
+        self.frames_transformed = 0
+
+    def start(self, now=None):
+        """ Call right after the capture PCM has been opened """
+
+        self.start_time = time.time() if now is None else now
+        self.samples_taken = 0
+        self.last_frame_time = None
+
+    def backlog_periods(self, now=None):
+        """ Whole periods the capture should have buffered since we last read from it """
+
+        if now is None:
+            now = time.time()
+
+        expected_samples = int((now - self.start_time) * self.sample_rate)
+        if expected_samples < self.samples_taken:
+            # Device clock is running ahead of wall time; rather than give up, line the two back up
+            self.start_time = now - self.samples_taken / self.sample_rate
+            return 0
+
+        return int((expected_samples - self.samples_taken) / self.period_size)
+
+    def work(self):
+        """ Seconds of the scheduler's own work per displayed frame, with the transform spread over transform_stride frames """
+
+        return (self.capture_cost or 0) + (self.transform_cost or 0) / self.transform_stride
+
+    def estimated_latency(self, stride=None):
+        """ Seconds from a sample being captured to its spectrum being ready, at the current transform_stride or, for
+            stride, predicted by assuming that only the transform's share of each frame changes """
+
+        if stride is None:
+            stride = self.transform_stride
+
+        transform_cost = self.transform_cost or 0
+        interval_change = transform_cost / stride - transform_cost / self.transform_stride
+        frame_interval = max(0, (self.frame_interval or 0) + interval_change)
+        backlog = max(0, (self.backlog or 0) + interval_change)     # Reads come round that much sooner or later too
+
+        return backlog + (stride - 1) * frame_interval + (self.capture_cost or 0) + transform_cost
+
+    def read_pcm(self, pcm, decode=normalize_pcm, now=None):
+        """ Drain the capture backlog into ram_ft. Returns the number of samples fed in """
+
+        periods = self.backlog_periods(now)
+
+        backlog = periods * self.period_duration
+        self.backlog = backlog if self.backlog is None else self.smoothing * backlog + (1 - self.smoothing) * self.backlog
+
+        if periods > self.max_useful_periods:
+            dummy_periods = periods - self.max_useful_periods
+            for i in range(dummy_periods):
+
+                read_raw = pcm.read()
+                self.samples_taken += self.period_size
+                self.periods_dropped += 1
+
+                if read_raw[0] < 0:
+                    # Overrun; the device restarted with an empty buffer, so none of the backlog is left to read
+                    remaining_periods = periods - i - 1
+                    self.samples_taken += remaining_periods * self.period_size
+                    self.periods_dropped += remaining_periods
+                    return 0
+
+            periods = self.max_useful_periods
+
+        chunks = []
+        for i in range(periods):
+
+            read_raw = pcm.read()
+            self.samples_taken += self.period_size
+
+            if read_raw[0] != self.period_size:
+                # Short read or overrun (negative frame count); whatever was in flight is gone
+                self.periods_dropped += periods - i
+                self.samples_taken += (periods - i - 1) * self.period_size
+                break
+
+            chunks.append(read_raw[1])
+
+        if len(chunks) == 0:
+            return 0
+
+        if self.probe is not None:
+            self.probe.stamp('capture')
+
+        start_time = time.time()
+
+        samples = decode(b''.join(chunks), len(chunks) * self.period_size)
+        self.ram_ft.intake_samples(samples)
+
+        cost = time.time() - start_time
+        self.capture_cost = cost if self.capture_cost is None else self.smoothing * cost + (1 - self.smoothing) * self.capture_cost
+
+        if self.probe is not None:
+            self.probe.stamp('intake')
+
+        return len(samples)
+
+    def transform(self):
+        """ Run full_transform at the current degrade level and fold its cost into the moving average """
+
+        start_time = time.time()
+
+        if self.degrade_level == 0:
+            self.ram_ft.full_transform()
+        elif self.degrade_level == 1:
+            self.ram_ft.full_transform(beautified_size=self.ram_ft.frequency_spectrum_size_degraded)
+        else:
+            self.ram_ft.full_transform(skip_interpolation=True)
+
+        cost = time.time() - start_time
+
+        if self.probe is not None:
+            self.probe.stamp('transform')
+        self.transform_cost = cost if self.transform_cost is None else self.smoothing * cost + (1 - self.smoothing) * self.transform_cost
+
+        self.frames_transformed += 1
+        if self.degrade_level > 0:
+            self.frames_degraded += 1
+
+    def adapt(self):
+        """ Step load down (degrade, then stride) while estimated latency is over target, back up once there's room.
+            Only steps that would bring latency down are taken; a slow render loop alone never triggers anything """
+
+        latency = self.estimated_latency()
+        own_share = self.work() >= self.work_fraction * (self.frame_interval or 0)
+
+        if latency > self.target_latency:
+
+            self.comfortable_frames = 0
+            if self.degrade_level < 2 and own_share:
+                self.degrade_level += 1
+                self.transform_cost = None      # Re-measure at the new level
+            elif (self.degrade_level == 2 and self.transform_stride < self.max_transform_stride and
+                  self.estimated_latency(self.transform_stride + 1) < latency):
+                self.transform_stride += 1
+
+        elif latency + (self.transform_cost or 0) < self.target_latency:
+
+            self.comfortable_frames += 1
+            if self.comfortable_frames >= self.recovery_frames:
+                self.comfortable_frames = 0
+                if self.transform_stride > 1:
+                    self.transform_stride -= 1
+                elif self.degrade_level > 0:
+                    self.degrade_level -= 1
+                    self.transform_cost = None
+
+        else:
+            self.comfortable_frames = 0
+
+        if self.transform_stride > 1 and self.estimated_latency(self.transform_stride - 1) < self.estimated_latency():
+            self.transform_stride -= 1      # A lower stride is better whatever the target
+
+    def process(self, pcm, decode=normalize_pcm):
+        """ Do one frame's worth of capture and analysis. Returns True if ram_ft's spectra were updated """
+
+        now = time.time()
+        if self.start_time is None:
+            self.start(now)
+
+        if self.last_frame_time is not None:
+            interval = now - self.last_frame_time
+            self.frame_interval = interval if self.frame_interval is None else self.smoothing * interval + (1 - self.smoothing) * self.frame_interval
+        self.last_frame_time = now
+
+        self.hop_size += self.read_pcm(pcm, decode, now)
+        if self.hop_size == 0:
+            return False
+
+        self.frames_since_transform += 1
+        if self.frames_since_transform < self.transform_stride:
+            self.frames_coalesced += 1
+            return False
+
+        self.transform()
+        self.adapt()
+
+        self.frames_since_transform = 0
+        self.hop_size = 0
+
+        return True
+
+    def report(self):
+
+        return ('latency: ' + str(round(self.estimated_latency() * 1000, 1)) + 'ms (target ' + str(round(self.target_latency * 1000, 1)) + 'ms)' +
+                ', work: ' + str(round(self.work() * 1000, 1)) + 'ms' +
+                ', degrade_level: ' + str(self.degrade_level) + ', transform_stride: ' + str(self.transform_stride) +
+                ', transformed: ' + str(self.frames_transformed) + ', degraded: ' + str(self.frames_degraded) +
+                ', coalesced: ' + str(self.frames_coalesced) + ', dropped periods: ' + str(self.periods_dropped))
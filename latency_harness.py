@@ -0,0 +1,308 @@
+import numpy as np
+import math
+import time
+from rammi_fft import *
+from frame_scheduler import *
+
+## This program measures how stale the spectrum on screen is. A known tone burst is injected into the audio, and the
+## time from the burst starting to the rendered pixels changing is recorded, along with when the frame that showed it
+## passed each stage on the way (capture, intake_samples, full_transform, render).
+
+## Tune period_size, buf_size and frame rate at the bottom of this file and run it; the default synthetic source needs no
+## audio hardware. Setting use_loopback plays the bursts out of playback_pcm and records them back in through
+## recording_pcm as in alsaaudio_cheatsheet.py, which adds the real device latency on top.
+
+## Frames are drawn and flipped in a pygame window as most_basic_visualizer.py does, so the render stage includes drawing
+## and presenting. With use_pygame off only the bar heights are computed, and render then measures little more than the
+## transform.
+
+class LatencyProbe (object):
+
+    """
+    LatencyProbe matches audio events (tone bursts) against the first rendered frame whose pixels show them.
+
+    Sources call event_emitted() with the time each burst entered the capture. A FrameScheduler given the probe stamps
+    the capture, intake and transform stages, and the render loop calls rendered() with whatever it just drew:
+
+        probe = LatencyProbe()
+        scheduler = FrameScheduler(ram_ft, probe=probe)
+        ...
+        scheduler.process(source)
+        probe.rendered(somehow_display(ram_ft.frequency_spectrum_final))
+        ...
+        print(probe.report())
+
+    A frame counts as showing the burst once the sum of its pixels rises more than threshold times above the quiet
+    level (plus min_delta, so a silent baseline doesn't trigger on noise). self.latencies holds, per stage, the
+    seconds between each detected burst and that frame passing the stage.
+    """
+
+    stages = ('capture', 'intake', 'transform', 'render')
+
+    def __init__(self, threshold=2.0, min_delta=50, timeout=0.5, smoothing=0.1):
+
+        self.threshold = threshold
+        self.min_delta = min_delta
+        self.timeout = timeout          # Seconds after which an undetected burst is counted as missed
+        self.smoothing = smoothing      # Weight of the newest frame in the quiet level average
+
+        self.pending_events = []        # Emission times of bursts not yet seen on screen
+        self.frame_stamps = {}          # Stage -> time for the frame currently being built
+        self.quiet_level = None
+        self.showing_event = False      # Pixels are still above threshold from the last detected burst
+
+        self.latencies = {stage: [] for stage in self.stages}
+        self.events_missed = 0
+
+    def event_emitted(self, timestamp):
+
+        self.pending_events.append(timestamp)
+
+    def stamp(self, stage, timestamp=None):
+
+        self.frame_stamps[stage] = time.time() if timestamp is None else timestamp
+
+    def rendered(self, pixels, timestamp=None):
+        """ Call right after a frame has been drawn, with the drawn values (e.g. bar heights) """
+
+        self.stamp('render', timestamp)
+        now = self.frame_stamps['render']
+
+        while len(self.pending_events) > 0 and now - self.pending_events[0] > self.timeout:
+            self.pending_events.pop(0)
+            self.events_missed += 1
+
+        level = float(np.sum(pixels))
+
+        if self.quiet_level is None:
+            self.quiet_level = level
+
+        lit = level > self.quiet_level * self.threshold + self.min_delta
+
+        if lit and not self.showing_event and len(self.pending_events) > 0 and self.pending_events[0] <= now:
+            event_time = self.pending_events.pop(0)
+            for stage in self.stages:
+                if stage in self.frame_stamps:
+                    self.latencies[stage].append(self.frame_stamps[stage] - event_time)
+
+        self.showing_event = lit
+        if not lit:
+            self.quiet_level = self.smoothing * level + (1 - self.smoothing) * self.quiet_level
+
+        self.frame_stamps = {}
+
+    def report(self):
+
+        lines = ['events detected: ' + str(len(self.latencies['render'])) + ', missed: ' + str(self.events_missed)]
+
+        for stage in self.stages:
+            values = np.array(self.latencies[stage]) * 1000
+            if len(values) == 0:
+                lines.append(stage + ': no data')
+                continue
+            lines.append(stage + ': min ' + str(round(np.min(values), 1)) + 'ms, median ' + str(round(np.median(values), 1)) +
+                         'ms, p90 ' + str(round(np.percentile(values, 90), 1)) + 'ms, p99 ' + str(round(np.percentile(values, 99), 1)) +
+                         'ms, max ' + str(round(np.max(values), 1)) + 'ms')
+
+        return '\n'.join(lines)
+
+class SyntheticSource (object):
+
+    """
+    SyntheticSource stands in for a PCM_NORMAL capture PCM (mono, PCM_FORMAT_S16_LE). read() blocks until the next
+    period would have been recorded in real time and returns it, low level noise with a sine burst every
+    burst_interval seconds. The capture time of each burst's first sample is reported to the probe.
+    """
+
+    def __init__(self, probe, sample_rate=44100, period_size=64, burst_frequency=1000, burst_duration=0.03,
+                 burst_interval=0.5, amplitude=0.5, noise=0.001):
+
+        self.probe = probe
+        self.sample_rate = sample_rate
+        self.period_size = period_size
+
+        self.burst_frequency = burst_frequency
+        self.burst_samples = int(burst_duration * sample_rate)
+        self.interval_samples = int(burst_interval * sample_rate)
+        self.amplitude = amplitude
+        self.noise = noise
+
+        self.start_time = None
+        self.samples_produced = 0
+
+    def start(self, now=None):
+
+        self.start_time = time.time() if now is None else now
+        self.samples_produced = 0
+
+    def signal(self, first_sample, count):
+        """ The test signal for samples [first_sample, first_sample + count), reporting any burst onsets in it """
+
+        index = np.arange(first_sample, first_sample + count)
+        phase = index % self.interval_samples
+
+        samples = np.random.normal(0, self.noise, count)
+        bursting = phase < self.burst_samples
+        samples[bursting] += self.amplitude * np.sin(2 * np.pi * self.burst_frequency * index[bursting] / self.sample_rate)
+
+        for onset in index[phase == 0]:
+            self.probe.event_emitted(self.start_time + onset / self.sample_rate)
+
+        return samples
+
+    def read(self):
+
+        if self.start_time is None:
+            self.start()
+
+        period_end = self.start_time + (self.samples_produced + self.period_size) / self.sample_rate
+        wait = period_end - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        samples = self.signal(self.samples_produced, self.period_size)
+        self.samples_produced += self.period_size
+
+        return (self.period_size, (np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+class LoopbackSource (SyntheticSource):
+
+    """
+    LoopbackSource plays the same test signal through a playback PCM one period per read(), and returns what the capture
+    PCM recorded. Bursts are timed from when they were handed to playback, so the result includes the device latency.
+    Both PCMs should be opened as mono, PCM_NORMAL, with the same period size.
+    """
+
+    def __init__(self, probe, recording_pcm, playback_pcm, **kwargs):
+
+        SyntheticSource.__init__(self, probe, **kwargs)
+        self.recording_pcm = recording_pcm
+        self.playback_pcm = playback_pcm
+
+    def read(self):
+
+        if self.start_time is None:
+            self.start()
+
+        # Onsets are reported relative to start_time, so move it to line the next period up with now
+        self.start_time = time.time() - self.samples_produced / self.sample_rate
+
+        samples = self.signal(self.samples_produced, self.period_size)
+        self.samples_produced += self.period_size
+        self.playback_pcm.write((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+        return self.recording_pcm.read()
+
+def bar_heights(collection, h=500):
+    """ Pixel heights of the bars most_basic_visualizer.bar_graph would draw for collection. Draws nothing """
+
+    return np.round(np.clip(collection, 0, 1) * (h - 2))
+
+class PygameRenderer (object):
+
+    """
+    PygameRenderer draws a spectrum as bars in a pygame window the way most_basic_visualizer.bar_graph does, flips the
+    display and returns the bar heights read back from the window's pixels (same units as bar_heights), so a probe
+    stamped when it returns has seen the frame presented. Whether flip() waits for the screen to actually show it
+    depends on the driver and vsync, so that part may still be missing.
+    """
+
+    def __init__(self, width=950, height=500, color=(120, 255, 120)):
+
+        import pygame
+        import pygame.surfarray
+
+        self.pygame = pygame
+        self.width = width
+        self.height = height
+        self.color = color
+
+        pygame.init()
+        self.screen = pygame.display.set_mode((width, height))
+
+    def __call__(self, collection):
+
+        pygame = self.pygame
+        self.screen.fill((0, 0, 0))
+
+        heights = bar_heights(collection, self.height)
+        bar_width = max(1, int((self.width - 2) / len(heights)))
+        columns = 1 + np.arange(len(heights)) * bar_width
+        for i in range(len(heights)):
+            if heights[i] > 0:
+                self.screen.fill(self.color, rect=pygame.Rect(columns[i], 1, bar_width, int(heights[i])))
+
+        pygame.display.flip()
+        pygame.event.pump()     # Keeps the window responsive
+
+        pixels = pygame.surfarray.pixels3d(self.screen)     # (width, height, 3) view of what was just presented
+        drawn = np.count_nonzero(pixels[columns].any(axis=2), axis=1)
+        del pixels                                          # Unlocks the surface for the next frame
+
+        return drawn
+
+def measure(ram_ft, source, probe, duration=10, frame_rate=60, target_latency=0.05, render=bar_heights):
+    """ Run capture -> analysis -> render for [duration] seconds and return the FrameScheduler that was used.
+        render(spectrum) should draw and present the frame and return what it drew; the render stage is stamped when it
+        returns (see PygameRenderer) """
+
+    scheduler = FrameScheduler(ram_ft, sample_rate=source.sample_rate, period_size=source.period_size,
+                               target_latency=target_latency, probe=probe)
+
+    frame_duration = 1 / frame_rate
+    start_time = time.time()
+    source.start(start_time)
+    scheduler.start(start_time)
+
+    next_frame = start_time
+    while time.time() - start_time < duration:
+
+        scheduler.process(source)
+        probe.rendered(render(ram_ft.frequency_spectrum_final))
+
+        next_frame += frame_duration
+        wait = next_frame - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        else:
+            next_frame = time.time()
+
+    return scheduler
+
+if __name__ == '__main__':
+
+    sample_rate = 44100
+    period_size = 64
+    buf_size = 1024
+    frame_rate = 60
+    duration = 10
+
+    use_loopback = False
+    use_pygame = True       # Off: render is not drawn or presented, see the top of this file
+
+    probe = LatencyProbe()
+    ram_ft = RammiFFT(sr=sample_rate, buf_size=buf_size)
+
+    if use_loopback:
+        from alsaaudio import *
+
+        recording_pcm = PCM(type=PCM_CAPTURE, mode=PCM_NORMAL, device='pulse')
+        playback_pcm = PCM(type=PCM_PLAYBACK, mode=PCM_NORMAL, device='default')
+        for pcm in (recording_pcm, playback_pcm):
+            pcm.setchannels(1)
+            pcm.setrate(sample_rate)
+            pcm.setperiodsize(period_size)
+
+        source = LoopbackSource(probe, recording_pcm, playback_pcm, sample_rate=sample_rate, period_size=period_size)
+    else:
+        source = SyntheticSource(probe, sample_rate=sample_rate, period_size=period_size)
+
+    render = PygameRenderer() if use_pygame else bar_heights
+
+    scheduler = measure(ram_ft, source, probe, duration=duration, frame_rate=frame_rate, render=render)
+
+    print('period_size: ' + str(period_size) + ', buf_size: ' + str(buf_size) + ', frame_rate: ' + str(frame_rate))
+    if not use_pygame:
+        print('render excludes drawing and display (use_pygame is off)')
+    print(probe.report())
+    print(scheduler.report())
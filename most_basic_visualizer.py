@@ -3,100 +3,41 @@ sys.path.insert(0, '/home/rammschnev/Desktop/Items_of_Interest/DEVELOPMENT/Audio
 import pygame
 import pygame.gfxdraw
 from rammi_fft import *
+from frame_scheduler import *
+from spectrum_log import *
 from alsaaudio import *
 import time as t
 
                                                     ## Rammi World ##
 
-ram_ft = RammiFFT()
+log_path = None         # Set to a file name to keep every frame's spectra on disk (see spectrum_log.py)
+replay_path = None      # Set to a spectrum log to draw that instead of live audio
+replay_speed = 1.0
+
+if replay_path is not None:
+    replay = SpectrumReplay(replay_path, speed=replay_speed)
+    ram_ft = replay.ram_ft
+else:
+    replay = None
+    ram_ft = RammiFFT()
 
 pcm_device = 'pulse'
 period_size = 64
 sample_rate = 44100
-max_useful_periods = int(ram_ft.time_domain_buffer_size / period_size)
-samples_overflow = 0    # This number reflects 'remainder' samples that would have been recorded in a read but did not reach a full period size.
-                        # When this reaches the period size, we will add an extra period to the next read to keep us current
-
-recording_pcm = PCM(type=PCM_CAPTURE, mode=PCM_NORMAL, device=pcm_device)
-recording_pcm.setchannels(1)
-recording_pcm.setperiodsize(period_size)
-
-global_start_time = t.time()
-total_samples_taken = 0
-
-def read_pcm():
-
-    global recording_pcm
-    global time_of_last_audio_capture
-    global samples_overflow
-    global total_samples_taken
-
-    start_time = t.time()
-    inter_time = start_time
-
-    running_time = t.time() - global_start_time
-    audio_time = total_samples_taken / sample_rate  # This is the amount of time we've captured audio of over the life of the program
-    delta_time = running_time - audio_time
-    if delta_time < 0:
-        raise ValueError('read_pcm: delta_time < 0 --> ipso facto, our audio time has gotten ahead of our real time somehow')
-
-    desired_samples = int(round(delta_time * sample_rate))
-    desired_periods = int(desired_samples / period_size)
-    #print('desired_samples: ' + str(desired_samples))
-    #print('desired_periods: ' + str(desired_periods))
-    samples_overflow += desired_samples - desired_periods * period_size
-    if samples_overflow >= period_size:
-        desired_periods += 1
-        samples_overflow -= period_size
-    #print('samples_overflow: ' + str(samples_overflow))
-    total_samples_taken += desired_periods * period_size
-
-    #print('read_pcm: determining iterations: ' + str(t.time() - inter_time))
-    inter_time = t.time()
-
-    if desired_periods == 0:
-        #print('read_pcm: desired_periods = 0, return')
-        return
+target_latency = 0.05   # Seconds; the scheduler sheds load (see FrameScheduler) to keep the spectrum at most this stale
 
-    if desired_periods > max_useful_periods:
-        
-        desired_dummy_periods = desired_periods - max_useful_periods
-        for i in range(desired_dummy_periods):
-            recording_pcm.read()
-        desired_periods = max_useful_periods
-        #print('read_pcm: dummy periods * ' + str(desired_dummy_periods) + ': ' + str(t.time() - inter_time))
-        inter_time = t.time()
-
-    processed_pcm = np.array([])
-    for i in range(desired_periods):
-
-        read_raw = recording_pcm.read()
-        if read_raw[0] != period_size:
-            raise ValueError('read_pcm: got period of size ' + str(read_raw[0]) + ', wanted ' + str(period_size))
-        read_processed = np.fromstring(read_raw[1], dtype='<u2', count=read_raw[0], sep='')
-        processed_pcm = np.concatenate((processed_pcm, read_processed))
-
-    #print('read_pcm: real periods * ' + str(desired_periods) + ': ' + str(t.time() - inter_time))
-    inter_time = t.time()
-
-    # Normalize to [-1, 1]
-    processed_pcm /= 32767.5
-    processed_pcm -= 1
-
-    # So this is some weird fucking voodoo that I had to piece together. Basically the PCM results are "inside out" and this corrects it
-    for i in range(len(processed_pcm)):
-        if processed_pcm[i] == 0:
-            continue
-        elif processed_pcm[i] > 0:
-            processed_pcm[i] = -1 + processed_pcm[i]
-        else:
-            processed_pcm[i] = 1 + processed_pcm[i]
-
-    processed_pcm *= 2 # Just some amplification to increase visibility
-    
-    #print('read_pcm: ' + str(t.time() - start_time))
+scheduler = FrameScheduler(ram_ft, sample_rate=sample_rate, period_size=period_size, target_latency=target_latency)
+
+spectrum_log = None
+if log_path is not None:
+    spectrum_log = SpectrumLogWriter(log_path, ram_ft, stages=('avg', 'final'))
 
-    ram_ft.intake_samples(processed_pcm)
+if replay is None:
+    recording_pcm = PCM(type=PCM_CAPTURE, mode=PCM_NORMAL, device=pcm_device)
+    recording_pcm.setchannels(1)
+    recording_pcm.setperiodsize(period_size)
+
+    scheduler.start()
 
 def run_transforms():
     
@@ -155,8 +96,10 @@ def main_loop():
 
     screen.fill((0, 0, 0))
     
-    read_pcm()
-    ram_ft.full_transform()
+    if replay is not None:
+        replay.update()
+    elif scheduler.process(recording_pcm) and spectrum_log is not None:
+        spectrum_log.append()
 
     bar_graph(0, 0, width, int(height / 2), ram_ft.frequency_spectrum_avg, bar_width=1, color=(120, 120, 255))
     bar_graph(0, int(height / 2), width, int(height / 2), ram_ft.frequency_spectrum_final, bar_width = 1, color=(120, 255, 120))
@@ -165,19 +108,31 @@ def main_loop():
 
     clock.tick(desired_frame_rate)
     print('framerate: ' + str(clock.get_fps()))
-    print('Total time: ' + str(t.time() - global_start_time))
-    print('Audio time: ' + str(total_samples_taken / sample_rate))
+
+    if replay is not None:
+        print('Replay frame: ' + str(replay.frame) + ' / ' + str(len(replay.log)))
+        return
+
+    print('Total time: ' + str(t.time() - scheduler.start_time))
+    print('Audio time: ' + str(scheduler.samples_taken / sample_rate))
+    print(scheduler.report())
 
 if __name__ == '__main__':
 
-    while True:
+    running = True
+    try:
+        while running:
 
-        main_loop()
+            main_loop()
 
-        for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE: # Escape
-                    pygame.quit()
+            for event in pygame.event.get():
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE: # Escape
+                        running = False
+    finally:
+        if spectrum_log is not None:
+            spectrum_log.close()
+        pygame.quit()
 
 
 
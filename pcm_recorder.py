@@ -0,0 +1,245 @@
+import numpy as np
+import mmap
+import os
+import select
+import struct
+import time
+
+## Streaming PCM recorder. Captured periods are copied straight into a memory-mapped WAV file that grows in fixed size
+## chunks, so a session can run for longer than there is RAM and nothing is kept in Python lists along the way. The
+## RIFF and data chunk sizes are left as placeholders while recording and patched in on close().
+
+## Recordings can be replayed immediately with MappedWavReader, which maps the data chunk as a numpy array.
+
+wav_header_size = 44
+wav_size_limit = 0xFFFFFFFF     # RIFF sizes are 32 bit; longer recordings say this and readers go by the file size instead
+
+def deinterleave(frames, channels=2, dtype='<i2'):
+    """ Split interleaved PCM bytes (or an array) into one strided numpy view per channel, without copying """
+
+    samples = np.frombuffer(frames, dtype=dtype) if isinstance(frames, (bytes, bytearray, memoryview)) else np.asarray(frames)
+    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+
+    return tuple(samples[:, c] for c in range(channels))
+
+def wav_header(sample_rate, channels, sample_width, data_size):
+
+    byte_rate = sample_rate * channels * sample_width
+    block_align = channels * sample_width
+
+    return (b'RIFF' + struct.pack('<I', min(36 + data_size, wav_size_limit)) + b'WAVE' +
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, byte_rate, block_align, sample_width * 8) +
+            b'data' + struct.pack('<I', min(data_size, wav_size_limit)))
+
+class MappedWavWriter (object):
+
+    """
+    MappedWavWriter streams PCM bytes into a WAV file through a sliding memory-mapped window.
+
+    Typical usage:
+
+        writer = MappedWavWriter('session.wav', sample_rate=44100, channels=2)
+        writer.write(recording_pcm.read()[1])
+        ...
+        writer.close()
+
+    The file is extended [chunk_size] bytes at a time and only the chunk being written to is mapped, so the page cache
+    rather than the process holds on to what has been written. chunk_size is rounded up to mmap.ALLOCATIONGRANULARITY.
+    """
+
+    def __init__(self, path, sample_rate=44100, channels=2, sample_width=2, chunk_size=16 * 1024 * 1024):
+
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_size = channels * sample_width
+
+        self.chunk_size = -(-chunk_size // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+
+        self.file = open(path, 'w+b')
+        self.file.write(wav_header(sample_rate, channels, sample_width, 0))     # Sizes are patched on close()
+
+        self.data_size = 0      # Bytes of PCM data written so far
+        self.window = None      # mmap of the chunk being written to
+        self.window_index = -1
+
+    @property
+    def frames_written(self):
+
+        return self.data_size // self.frame_size
+
+    def map_window(self, index):
+
+        if self.window is not None:
+            self.window.close()
+
+        end = (index + 1) * self.chunk_size
+        if os.fstat(self.file.fileno()).st_size < end:
+            self.file.truncate(end)
+
+        self.window = mmap.mmap(self.file.fileno(), self.chunk_size, offset=index * self.chunk_size)
+        self.window_index = index
+
+    def write(self, data):
+        """ Append PCM bytes (or anything exposing the buffer protocol) at the end of the data chunk """
+
+        data = memoryview(data).cast('B')
+        written = 0
+
+        while written < len(data):
+
+            position = wav_header_size + self.data_size
+            index, offset = divmod(position, self.chunk_size)
+            if index != self.window_index:
+                self.map_window(index)
+
+            count = min(len(data) - written, self.chunk_size - offset)
+            self.window[offset : offset + count] = data[written : written + count]
+
+            written += count
+            self.data_size += count
+
+    def close(self):
+
+        if self.file.closed:
+            return
+
+        try:
+            if self.window is not None:
+                self.window.flush()
+                self.window.close()
+                self.window = None
+
+            self.file.seek(0)
+            self.file.write(wav_header(self.sample_rate, self.channels, self.sample_width, self.data_size))
+            self.file.truncate(wav_header_size + self.data_size)
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+class MappedWavReader (object):
+
+    """
+    MappedWavReader maps the data chunk of a 16-bit PCM WAV file as a read-only (frames, channels) numpy array, so a
+    recording of any length can be replayed or analyzed straight away without loading it.
+
+        reader = MappedWavReader('session.wav')
+        left, right = reader.channel(0), reader.channel(1)
+        for period in reader.periods(32):
+            playback_pcm.write(period)
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+
+            riff_header = f.read(12)
+            if riff_header[:4] != b'RIFF' or riff_header[8:12] != b'WAVE':
+                raise ValueError('MappedWavReader.__init__: ' + str(path) + ' is not a WAV file')
+
+            fmt = None
+            while True:
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    raise ValueError('MappedWavReader.__init__: ' + str(path) + ' has no data chunk')
+
+                chunk_id, chunk_size = chunk_header[:4], struct.unpack('<I', chunk_header[4:])[0]
+                if chunk_id == b'fmt ':
+                    fmt = struct.unpack('<HHIIHH', f.read(16))
+                    f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+                elif chunk_id == b'data':
+                    data_offset = f.tell()
+                    available = os.fstat(f.fileno()).st_size - data_offset
+                    # A file whose writer never got to close() still says 0, so take everything up to the end (including
+                    # the unused tail of its last chunk, which is silence). Past 4 GiB the size is pinned at
+                    # wav_size_limit, which also means "up to the end"
+                    data_size = min(chunk_size, available) if 0 < chunk_size < wav_size_limit else available
+                    break
+                else:
+                    f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+        if fmt is None or fmt[0] != 1 or fmt[5] != 16:
+            raise ValueError('MappedWavReader.__init__: ' + str(path) + ' is not 16-bit PCM')
+
+        self.channels = fmt[1]
+        self.sample_rate = fmt[2]
+        self.frames = data_size // (2 * self.channels)
+
+        if self.frames == 0:
+            self.data = np.zeros((0, self.channels), dtype='<i2')
+        else:
+            self.data = np.memmap(path, dtype='<i2', mode='r', offset=data_offset, shape=(self.frames, self.channels))
+
+    def channel(self, index):
+        """ Strided view of one channel """
+
+        return self.data[:, index]
+
+    def periods(self, period_size=32):
+        """ Yield the recording [period_size] frames at a time as bytes, ready for pcm.write() """
+
+        for start in range(0, self.frames, period_size):
+            yield self.data[start : start + period_size].tobytes()
+
+def poll_revents(pcm, poller, descriptors, timeout=0):
+    """ Poll a PCM's descriptors (registered with poller) and return what the wakeup means for the PCM itself.
+
+        ALSA plugins (e.g. pulse) don't always use their descriptors to mean "readable", and leave them firing until
+        polldescriptors_revents() has looked at them, so when the PCM has it (pyalsaaudio does) the events go through it """
+
+    ready = dict(poller.poll(timeout))
+
+    if hasattr(pcm, 'polldescriptors_revents'):
+        return pcm.polldescriptors_revents([(fd, ready.get(fd, 0)) for fd, event_mask in descriptors])
+
+    revents = 0
+    for events in ready.values():
+        revents |= events
+    return revents
+
+def wait_for_period(pcm, timeout=1000):
+    """ Block on a PCM_NONBLOCK pcm's poll descriptors until it has something to read (or an error to report), instead
+        of spinning. Returns False if nothing came within timeout milliseconds """
+
+    descriptors = list(pcm.polldescriptors())
+    poller = select.poll()
+    for fd, event_mask in descriptors:
+        poller.register(fd, event_mask)
+
+    deadline = time.time() + timeout / 1000
+    while True:
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        if poll_revents(pcm, poller, descriptors, remaining * 1000) & (select.POLLIN | select.POLLERR):
+            return True
+
+def record_to_wav(pcm, path, number_of_periods, sample_rate=44100, channels=2):
+    """ Stream [number_of_periods] periods from a capture pcm into a WAV file at path. Returns the frames recorded """
+
+    with MappedWavWriter(path, sample_rate=sample_rate, channels=channels) as writer:
+
+        periods = 0
+        while periods < number_of_periods:
+
+            frames, data = pcm.read()
+            if frames > 0:
+                writer.write(data)
+                periods += 1
+            elif frames == 0:
+                wait_for_period(pcm)
+            # Negative frames means an overrun; the next read picks up from there
+
+        return writer.frames_written
@@ -1,6 +1,7 @@
 import numpy as np
 import scipy.interpolate
 import math
+import threading
 import time
 
 class RammiFFT (object):
@@ -35,12 +36,24 @@ class RammiFFT (object):
         * self.frequency_spectrum_size_loudness_adj
         * self.frequency_spectrum_size_trimmed
         * self.frequency_spectrum_size_interpolated
+        * self.frequency_spectrum_size_degraded     half of beautified_size, prebuilt for shedding load (see interpolate)
         * self.logarithmic_transformation_curve
 
         * self.sample_rate
         * self.nyquist
+
+    avg_per_oct, ref_ratio, trim_ratio and beautified_size can be changed on a live instance with reconfigure().
+
+    Any one of the passes can also be kept as a scrolling history (see SpectrumHistory):
+
+        ram_ft.enable_history('final', capacity=512)
+        ...
+        somehow_display_waterfall(ram_ft.history.view())
     """
 
+    # Names accepted by enable_history; each maps onto self.frequency_spectrum_<name>
+    history_stages = ('raw', 'avg', 'loudness_adj', 'trimmed', 'interpolated', 'final')
+
     def __init__(self, sr=44100, buf_size=1024, avg_per_oct=4, ref_ratio=1/3, trim_ratio = 9/10, beautified_size=256):
 
             ## Vanilla Fourier Transform
@@ -87,47 +100,193 @@ class RammiFFT (object):
             self.octaves_in_spectrum += 1
             nyq /= 2
 
-        self.averages_per_octave = avg_per_oct   # WE ARE FREE TO SET THIS VALUE DIRECTLY, DOES NOT IMPACT ANY OTHER PART OF THE MATH
+        # Everything below depends on avg_per_oct, ref_ratio, trim_ratio or beautified_size, so it is built by the build_*
+        # methods, which reconfigure() reuses to rebuild only what a change affects
+
+        tables = self.build_band_map(avg_per_oct)
+        tables.update(self.build_loudness_curve(tables['frequency_spectrum_size_avg'], ref_ratio))
+        tables.update(self.build_trim(tables['frequency_spectrum_size_avg'], trim_ratio))
+        tables.update(self.build_interpolation_operator(tables['frequency_spectrum_size_trimmed'], beautified_size))
+        self.__dict__.update(tables)
+
+        self.lock = threading.Lock()    # Held for a whole full_transform; reconfigure swaps its tables in under it
+
+            ## History
+
+        self.history_stage = None       # Set by enable_history
+        self.history = None             # SpectrumHistory of the chosen stage, appended once per full_transform
+
+    def config(self):
+        """ Constructor arguments that would build an identical RammiFFT, i.e. RammiFFT(**ram_ft.config()) """
+
+        return {'sr': self.sample_rate, 'buf_size': self.time_domain_buffer_size, 'avg_per_oct': self.averages_per_octave,
+                'ref_ratio': self.reference_point_as_ratio, 'trim_ratio': self.trim_point_as_ratio,
+                'beautified_size': self.frequency_spectrum_size_interpolated}
+
+    def build_band_map(self, avg_per_oct):
+        """ Which raw bands get averaged into each logarithmically spaced band (2nd PASS) """
+
+        averages_per_octave = avg_per_oct   # WE ARE FREE TO SET THIS VALUE DIRECTLY, DOES NOT IMPACT ANY OTHER PART OF THE MATH
+
+        frequency_spectrum_size_avg = self.octaves_in_spectrum * averages_per_octave
 
-        self.frequency_spectrum_size_avg = self.octaves_in_spectrum * self.averages_per_octave
-        self.frequency_spectrum_avg = np.array([0 for i in range(self.frequency_spectrum_size_avg)], dtype='float32')
+        band_low_indices = np.zeros(frequency_spectrum_size_avg, dtype='int64')
+        band_high_indices = np.zeros(frequency_spectrum_size_avg, dtype='int64')
+
+        for i in range(self.octaves_in_spectrum):
+
+            low_freq = 0 if i == 0 else self.nyquist / (2 ** (self.octaves_in_spectrum - i))    # These are the endpoints of whole octaves
+            high_freq = self.nyquist / (2 ** (self.octaves_in_spectrum - i - 1))
+            freq_step = (high_freq - low_freq) / averages_per_octave                              # This is the increment between those endpoints
+
+            f = low_freq
+            for j in range(averages_per_octave):
+
+                offset = j + i * averages_per_octave
+                band_low_indices[offset] = self.spectrum_index_from_frequency(f)
+                band_high_indices[offset] = self.spectrum_index_from_frequency(f + freq_step)     # Inclusive
+
+                f += freq_step
+
+        frequency_spectrum_avg = np.zeros(frequency_spectrum_size_avg, dtype='float32')
                                     # Logarithmically spaced frequency power value averages are stored here
                                     # (2nd PASS)
 
-            ## Loudness Adjustment
+        return {'averages_per_octave': averages_per_octave,
+                'frequency_spectrum_size_avg': frequency_spectrum_size_avg,
+                'band_low_indices': band_low_indices,
+                'band_high_indices': band_high_indices,
+                'frequency_spectrum_avg': frequency_spectrum_avg}
+
+    def build_loudness_curve(self, frequency_spectrum_size_avg, ref_ratio):
+        """ The curve loudness_adjust multiplies frequency_spectrum_avg by (3rd PASS) """
 
         reference_point_as_ratio = ref_ratio    # We are preparing to scale frequency_spectrum_avg by a logarithmic function, and this number represents the frequency band
                                                 # that we want to leave unchanged (log ... = 1.0) as a fraction of the whole buffer size
 
-        reference_index = int(round(self.frequency_spectrum_size_avg * reference_point_as_ratio)) - 1
+        reference_index = int(round(frequency_spectrum_size_avg * reference_point_as_ratio)) - 1
 
         # We add 1 to both values in math.log because we want to shave off all negative values while keeping the reference point the same
         # Look at a graph of y = log(x, b) for further reference
 
-        self.logarithmic_transformation_curve = np.array([math.log(i + 1, reference_index + 1) for i in range(len(self.frequency_spectrum_avg))])
+        logarithmic_transformation_curve = np.array([math.log(i + 1, reference_index + 1) for i in range(frequency_spectrum_size_avg)])
+
+        frequency_spectrum_loudness_adj = np.zeros(frequency_spectrum_size_avg, dtype='float32')   # Loudness adjusted version of averaged spectrum
+                                                                                                    # (3rd PASS)
 
-        self.frequency_spectrum_size_loudness_adj = self.frequency_spectrum_size_avg
-        self.frequency_spectrum_loudness_adj = np.array(self.frequency_spectrum_avg, dtype='float32')       # Loudness adjusted version of averaged spectrum
-                                                                                                            # (3rd PASS)
+        return {'reference_point_as_ratio': reference_point_as_ratio,
+                'logarithmic_transformation_curve': logarithmic_transformation_curve,
+                'frequency_spectrum_size_loudness_adj': frequency_spectrum_size_avg,
+                'frequency_spectrum_loudness_adj': frequency_spectrum_loudness_adj}
 
-            ## Trimming
+    def build_trim(self, frequency_spectrum_size_loudness_adj, trim_ratio):
+        """ Where trim cuts off the loudness adjusted spectrum (4th PASS) """
 
         trim_point_as_ratio = trim_ratio
-        self.trim_index = int(round(self.frequency_spectrum_size_loudness_adj * trim_point_as_ratio)) # deliberately not subtracting 1 from trim_index
+        trim_index = int(round(frequency_spectrum_size_loudness_adj * trim_point_as_ratio)) # deliberately not subtracting 1 from trim_index
 
-        self.frequency_spectrum_trimmed = self.frequency_spectrum_loudness_adj[:self.trim_index]
-        self.frequency_spectrum_trimmed[-1] = 0
+        frequency_spectrum_trimmed = np.zeros(trim_index, dtype='float32')
                                                         # Trimmed version of loudness adjusted spectrum, because high end
                                                         # of spectrum includes very little useful data and takes up space
                                                         # (4th PASS)
-        self.frequency_spectrum_size_trimmed = len(self.frequency_spectrum_trimmed)
 
-            ## Spline Interpolation
+        return {'trim_point_as_ratio': trim_point_as_ratio,
+                'trim_index': trim_index,
+                'frequency_spectrum_size_trimmed': trim_index,
+                'frequency_spectrum_trimmed': frequency_spectrum_trimmed}
+
+    def build_interpolation_operator(self, frequency_spectrum_size_trimmed, beautified_size):
+        """ Matrix that takes the trimmed spectrum to the interpolated one (5th PASS)
+
+            An interpolating spline (smoothing factor 0) is linear in the values it goes through, so rather than fitting
+            a new spline every frame we fit one per trimmed band to a unit impulse, once, and keep where each lands.
+
+            The same splines give the operator for frequency_spectrum_size_degraded, so that a frame interpolated at the
+            lower resolution costs less than a normal one from the first, rather than paying for the fits itself """
+
+        x_old = list(range(frequency_spectrum_size_trimmed))    # The original X axis of the frequency spectrum
+                                                                # We don't care about the actual frequency ranges for this purpose,
+                                                                # so we're just treating the array indices as the X axis
+        x_new = np.linspace(0, frequency_spectrum_size_trimmed - 1, beautified_size)
+
+        degraded_size = max(frequency_spectrum_size_trimmed, int(beautified_size / 2))
+        x_degraded = np.linspace(0, frequency_spectrum_size_trimmed - 1, degraded_size)
+
+        operator = np.zeros((beautified_size, frequency_spectrum_size_trimmed))
+        degraded_operator = np.zeros((degraded_size, frequency_spectrum_size_trimmed))
+        impulses = np.eye(frequency_spectrum_size_trimmed)
+        for i in range(frequency_spectrum_size_trimmed):
+            spline = scipy.interpolate.UnivariateSpline(x_old, impulses[i])
+            spline.set_smoothing_factor(0)
+            operator[:, i] = spline(x_new)
+            degraded_operator[:, i] = spline(x_degraded)
+
+        frequency_spectrum_interpolated = np.zeros(beautified_size)     # Trimmed spectrum filled in with interpolated values to raise resolution
+                                                                        # (5th PASS)
+
+        return {'frequency_spectrum_size_interpolated': beautified_size,
+                'interpolation_operator': operator,
+                'frequency_spectrum_size_degraded': degraded_size,
+                'interpolation_operators': {degraded_size: degraded_operator},  # Operators for other sizes, see interpolate
+                'frequency_spectrum_interpolated': frequency_spectrum_interpolated,
+                'frequency_spectrum_final': frequency_spectrum_interpolated}    # Same data with a more convenient name for end use
+
+    def reconfigure(self, avg_per_oct=None, ref_ratio=None, trim_ratio=None, beautified_size=None):
+        """ Change any of the display parameters without rebuilding the RammiFFT. Only the tables a change affects are
+            recomputed, the time domain buffer is kept, and the new tables are swapped in between frames
+
+            sr and buf_size can't be changed this way; they decide the time domain buffer itself """
+
+        config = self.config()
 
-        self.frequency_spectrum_size_interpolated = beautified_size                             # Trimmed spectrum filled in with interpolated values to raise resolution
-                                                                                                # (5th PASS)
-        self.frequency_spectrum_interpolated = np.array([0 for i in range(beautified_size)])
-        self.frequency_spectrum_final = self.frequency_spectrum_interpolated                    # Same data with a more convenient name for end use
+        changed_band_map = avg_per_oct is not None and avg_per_oct != config['avg_per_oct']
+        changed_curve = changed_band_map or (ref_ratio is not None and ref_ratio != config['ref_ratio'])
+        changed_trim = changed_band_map or (trim_ratio is not None and trim_ratio != config['trim_ratio'])
+        changed_interpolation = changed_trim or (beautified_size is not None and beautified_size != config['beautified_size'])
+
+        for name, value in (('avg_per_oct', avg_per_oct), ('ref_ratio', ref_ratio), ('trim_ratio', trim_ratio), ('beautified_size', beautified_size)):
+            if value is not None:
+                config[name] = value
+
+        # Built outside the lock so the frame in progress (if any) isn't held up
+
+        tables = {}
+        frequency_spectrum_size_avg = self.frequency_spectrum_size_avg
+        frequency_spectrum_size_trimmed = self.frequency_spectrum_size_trimmed
+
+        if changed_band_map:
+            tables.update(self.build_band_map(config['avg_per_oct']))
+            frequency_spectrum_size_avg = tables['frequency_spectrum_size_avg']
+
+        if changed_curve:
+            tables.update(self.build_loudness_curve(frequency_spectrum_size_avg, config['ref_ratio']))
+
+        if changed_trim:
+            tables.update(self.build_trim(frequency_spectrum_size_avg, config['trim_ratio']))
+            frequency_spectrum_size_trimmed = tables['frequency_spectrum_size_trimmed']
+
+        if changed_interpolation:
+            tables.update(self.build_interpolation_operator(frequency_spectrum_size_trimmed, config['beautified_size']))
+
+        with self.lock:
+
+            self.__dict__.update(tables)
+
+            # Redo the passes after the FFT from the last raw spectrum, so anything drawn before the next frame isn't blank
+            # or left over from the old tables. Each pass feeds the next, so everything after the first changed one reruns;
+            # trim zeroes the last band it keeps in frequency_spectrum_loudness_adj itself, so a new trim needs a clean
+            # loudness pass under it too
+            if changed_band_map:
+                self.transform_avg()
+            if changed_band_map or changed_curve or changed_trim:
+                self.loudness_adjust()
+                self.trim()
+            if changed_band_map or changed_curve or changed_trim or changed_interpolation:
+                self.interpolate()
+
+            # A history whose stage changed width can't carry on, so start it over at the new width
+            if self.history is not None and len(getattr(self, 'frequency_spectrum_' + self.history_stage)) != self.history.width:
+                self.history = SpectrumHistory(len(getattr(self, 'frequency_spectrum_' + self.history_stage)), self.history.capacity)
 
     def spectrum_index_from_frequency(self, freq):
 
@@ -193,30 +352,12 @@ class RammiFFT (object):
 
         start_time = time.time()
 
-        for i in range(self.octaves_in_spectrum):
-
-            low_freq = 0 if i == 0 else self.nyquist / (2 ** (self.octaves_in_spectrum - i))    # These are the endpoints of whole octaves
-            high_freq = self.nyquist / (2 ** (self.octaves_in_spectrum - i - 1))
-            freq_step = (high_freq - low_freq) / self.averages_per_octave                         # This is the increment between those endpoints
-
-            f = low_freq
-            for j in range(self.averages_per_octave):
-
-                # Actual averaging happens here
-                
-                low_index = self.spectrum_index_from_frequency(f)
-                high_index  = self.spectrum_index_from_frequency(f + freq_step)
-                average = 0
-
-                for k in range(low_index, high_index + 1):
-                    average += self.frequency_spectrum_raw[k]
+        # Actual averaging happens here; a running sum turns each band's mean into one subtraction
+        # (band_high_indices are inclusive)
 
-                average /= high_index - low_index + 1
-
-                offset = j + i * self.averages_per_octave
-                self.frequency_spectrum_avg[offset] = average
-
-                f += freq_step
+        cumulative = np.concatenate(([0], np.cumsum(self.frequency_spectrum_raw)))
+        self.frequency_spectrum_avg[:] = ((cumulative[self.band_high_indices + 1] - cumulative[self.band_low_indices]) /
+                                          (self.band_high_indices - self.band_low_indices + 1))
 
         #print('transform_avg: ' + str(time.time() - start_time))
 
@@ -231,25 +372,139 @@ class RammiFFT (object):
         self.frequency_spectrum_trimmed = self.frequency_spectrum_loudness_adj[:self.trim_index]
         self.frequency_spectrum_trimmed[-1] = 0
 
-    def interpolate(self):
+    def interpolate(self, size=None):
+        """ size overrides frequency_spectrum_size_interpolated for this frame only (used to shed load, see FrameScheduler).
+            frequency_spectrum_size_degraded is prebuilt; any other size fits its splines on first use """
 
-        x_old = list(range(self.frequency_spectrum_size_trimmed))  # The original X axis of the frequency spectrum
-                                                                        # We don't care about the actual frequency ranges for this purpose,
-                                                                        # so we're just treating the array indices as the X axis
+        if size is None or size == self.frequency_spectrum_size_interpolated:
+            operator = self.interpolation_operator
+        else:
+            if size not in self.interpolation_operators:
+                self.interpolation_operators[size] = self.build_interpolation_operator(self.frequency_spectrum_size_trimmed, size)['interpolation_operator']
+            operator = self.interpolation_operators[size]
 
-        spline = scipy.interpolate.UnivariateSpline(x_old, self.frequency_spectrum_trimmed)
-        spline.set_smoothing_factor(0)
+        self.frequency_spectrum_interpolated = operator @ self.frequency_spectrum_trimmed
+        #print(self.frequency_spectrum_interpolated)
+        self.frequency_spectrum_final = self.frequency_spectrum_interpolated
 
-        x_new = np.linspace(0, self.frequency_spectrum_size_trimmed - 1, self.frequency_spectrum_size_interpolated)
+    def enable_history(self, stage='final', capacity=512):
+        """ Start keeping the last [capacity] frames of the given stage. Any previously kept history is discarded """
 
-        self.frequency_spectrum_interpolated = spline(x_new)
-        print(self.frequency_spectrum_interpolated)
-        self.frequency_spectrum_final = self.frequency_spectrum_interpolated
+        if stage not in self.history_stages:
+            raise ValueError('RammiFFT.enable_history: stage ' + str(stage) + ' is not one of ' + str(self.history_stages))
+
+        self.history_stage = stage
+        self.history = SpectrumHistory(len(getattr(self, 'frequency_spectrum_' + stage)), capacity)
+
+    def disable_history(self):
+
+        self.history_stage = None
+        self.history = None
+
+    def full_transform(self, skip_interpolation=False, beautified_size=None):
+        """ skip_interpolation leaves frequency_spectrum_interpolated alone and points frequency_spectrum_final at the trimmed
+            spectrum instead; beautified_size interpolates to a different size for this frame only """
+
+        with self.lock:
+
+            self.transform_raw()
+            self.transform_avg()
+            self.loudness_adjust()
+            self.trim()
+
+            if skip_interpolation:
+                self.frequency_spectrum_final = self.frequency_spectrum_trimmed
+            else:
+                self.interpolate(beautified_size)
+
+            if self.history is not None:
+                self.history.append(getattr(self, 'frequency_spectrum_' + self.history_stage))
+
+class SpectrumHistory (object):
+
+    """
+    SpectrumHistory keeps the newest [capacity] frames of a spectrum in a preallocated 2-D circular buffer, so that
+    waterfalls, spectral flux, beat tracking etc. don't each need to keep their own list of copies.
+
+    Every frame is written twice, [capacity] rows apart, which means the newest [capacity] frames always sit in one
+    contiguous slice of self.buffer. view() hands out that slice without copying anything, oldest frame first:
+
+        history = SpectrumHistory(256, capacity=512)
+        history.append(spectrum)
+        somehow_display_waterfall(history.view())
+
+    Views are only valid until the next append; copy them if they need to be kept.
+    """
+
+    def __init__(self, width, capacity=512, dtype='float32'):
+
+        if capacity < 1:
+            raise ValueError('SpectrumHistory.__init__: capacity ' + str(capacity) + ' is less than 1')
+
+        self.width = width              # Number of bands per frame
+        self.capacity = capacity        # Number of frames kept
+
+        self.buffer = np.zeros((2 * capacity, width), dtype=dtype)
+        self.timestamps = np.zeros(2 * capacity, dtype='float64')   # time.time() of each frame, mirrored the same way as buffer
+
+        self.write_index = 0            # Row the next frame is written to (and write_index + capacity)
+        self.count = 0                  # Number of valid frames, tops out at capacity
+
+    def append(self, spectrum, timestamp=None):
+        """ Copy one frame into the history. Timestamps are expected to never decrease """
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        row = self.buffer[self.write_index]
+        if len(spectrum) == self.width:
+            row[:] = spectrum
+        else:
+            # A stage can change length between frames (e.g. a lower beautified_size), so stretch it to fit
+            row[:] = np.interp(np.linspace(0, len(spectrum) - 1, self.width), np.arange(len(spectrum)), spectrum)
+
+        self.buffer[self.write_index + self.capacity] = row
+        self.timestamps[self.write_index] = timestamp
+        self.timestamps[self.write_index + self.capacity] = timestamp
+
+        self.write_index = (self.write_index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def view(self, frames=None):
+        """ Zero-copy (frames, width) view of the newest [frames] frames in chronological order, all of them by default """
+
+        frames = self.count if frames is None else max(0, min(frames, self.count))
+        end = self.write_index + self.capacity
+        return self.buffer[end - frames : end]
+
+    def timestamp_view(self, frames=None):
+        """ Timestamps lining up with view(frames) """
+
+        frames = self.count if frames is None else max(0, min(frames, self.count))
+        end = self.write_index + self.capacity
+        return self.timestamps[end - frames : end]
+
+    def latest(self):
+
+        if self.count == 0:
+            raise IndexError('SpectrumHistory.latest: history is empty')
+
+        return self.buffer[self.write_index + self.capacity - 1]
+
+    def index_from_time(self, timestamp):
+        """ Index into view() of the newest frame taken at or before timestamp (0 if all frames are newer) """
+
+        if self.count == 0:
+            raise IndexError('SpectrumHistory.index_from_time: history is empty')
+
+        index = int(np.searchsorted(self.timestamp_view(), timestamp, side='right')) - 1
+        return max(index, 0)
+
+    def frame_at_time(self, timestamp):
+
+        return self.view()[self.index_from_time(timestamp)]
 
-    def full_transform(self):
+    def clear(self):
 
-        self.transform_raw()
-        self.transform_avg()
-        self.loudness_adjust()
-        self.trim()
-        self.interpolate()
+        self.write_index = 0
+        self.count = 0
@@ -0,0 +1,375 @@
+import numpy as np
+import json
+import os
+import struct
+import time
+from rammi_fft import *
+
+## Append-only on-disk log of RammiFFT output, so a session can be audited or re-rendered later without capturing or
+## transforming the audio again.
+
+## Layout of a log file:
+
+##      * magic                 b'RFFTLOG1'
+##      * header length         uint32, little endian
+##      * header                JSON: the RammiFFT config(), the logged stages and the record layout
+##      * padding               zeroes up to a multiple of 64 bytes
+##      * records               one fixed-width record per frame: '<f8' timestamp followed by one field per stage
+
+## Stages are stored as float32, or quantized to uint8/uint16 over a [low, high] range given per stage. Every
+## [index_interval] frames a (timestamp, frame number) pair is appended to a sparse index in [path].idx, which lets
+## lookups by time bisect the index before touching any record pages.
+
+## A log is one or more segments. When the RammiFFT is reconfigured while it is being logged, the writer finishes the
+## current segment and carries on in a new one with its own header, named [path].1, [path].2 and so on, so that every
+## frame is stored at the widths and with the config it was computed with.
+
+log_magic = b'RFFTLOG1'
+log_alignment = 64
+index_dtype = np.dtype([('timestamp', '<f8'), ('frame', '<u8')])
+
+quantized_max = {'uint8': 255, 'uint16': 65535}
+
+def segment_path(path, segment):
+
+    return path if segment == 0 else path + '.' + str(segment)
+
+def segment_paths(path):
+    """ Paths of all the segments of the log at path, in order """
+
+    paths = []
+    while os.path.exists(segment_path(path, len(paths))):
+        paths.append(segment_path(path, len(paths)))
+    return paths
+
+def stage_width(ram_ft, stage):
+    """ Width a stage has under the RammiFFT's current config (frequency_spectrum_final may differ on degraded frames) """
+
+    return getattr(ram_ft, 'frequency_spectrum_size_' + ('interpolated' if stage == 'final' else stage))
+
+def record_dtype(stages):
+
+    return np.dtype([('timestamp', '<f8')] + [(stage['name'], '<' + np.dtype(stage['dtype']).str[1:], (stage['width'],))
+                                             for stage in stages])
+
+class SpectrumLogWriter (object):
+
+    """
+    SpectrumLogWriter appends the chosen stages of a RammiFFT to a log file once per frame.
+
+    Typical usage:
+
+        spectrum_log = SpectrumLogWriter('session.rfft', ram_ft, stages=('avg', 'final'), dtype='uint8', scale=(0, 1))
+        ...
+        ram_ft.full_transform()
+        spectrum_log.append()
+        ...
+        spectrum_log.close()
+
+    Records and index entries are flushed to disk along with every index entry, and on close().
+
+    Widths are fixed per segment. A stage that comes out a different length on some frame (e.g. while FrameScheduler
+    has lowered beautified_size) is stretched to fit, the same way SpectrumHistory does it. If ram_ft.config() has
+    changed since the segment was started (see RammiFFT.reconfigure), the next append starts a new segment instead.
+    """
+
+    def __init__(self, path, ram_ft, stages=('final',), dtype='float32', scale=(0, 1), index_interval=256):
+
+        if dtype not in ('float32', 'uint8', 'uint16'):
+            raise ValueError('SpectrumLogWriter.__init__: dtype ' + str(dtype) + ' is not one of float32, uint8, uint16')
+
+        for name in stages:
+            if name not in RammiFFT.history_stages:
+                raise ValueError('SpectrumLogWriter.__init__: stage ' + str(name) + ' is not one of ' + str(RammiFFT.history_stages))
+
+        self.path = path
+        self.ram_ft = ram_ft
+        self.stage_names = tuple(stages)
+        self.stage_dtype = dtype
+        self.scale = list(scale)
+        self.index_interval = index_interval
+
+        self.file = None
+        self.index_file = None
+        self.segment = -1
+        self.frames_written = 0     # Across all segments
+
+        # Later segments left over from an earlier log at the same path would otherwise be replayed as part of this one
+        for stale_path in segment_paths(path)[1:]:
+            os.remove(stale_path)
+            if os.path.exists(stale_path + '.idx'):
+                os.remove(stale_path + '.idx')
+
+        self.open_segment()
+
+    def open_segment(self):
+        """ Start the next segment, with a header describing ram_ft as it is configured now """
+
+        if self.file is not None:
+            self.close()
+
+        self.segment += 1
+        self.segment_path = segment_path(self.path, self.segment)
+        self.config = self.ram_ft.config()
+
+        self.stages = [{'name': name, 'width': stage_width(self.ram_ft, name), 'dtype': self.stage_dtype, 'scale': self.scale}
+                       for name in self.stage_names]
+
+        self.dtype = record_dtype(self.stages)
+        self.record = np.zeros(1, dtype=self.dtype)     # Reused for every frame
+
+        header = json.dumps({'version': 1, 'config': self.config, 'stages': self.stages, 'segment': self.segment,
+                             'record_size': self.dtype.itemsize, 'index_interval': self.index_interval}).encode('utf-8')
+        preamble = log_magic + struct.pack('<I', len(header)) + header
+        padding = -len(preamble) % log_alignment
+
+        self.file = open(self.segment_path, 'wb')
+        self.file.write(preamble + b'\x00' * padding)
+        self.index_file = open(self.segment_path + '.idx', 'wb')
+
+        self.segment_frames = 0
+
+    def append(self, timestamp=None):
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        if self.ram_ft.config() != self.config:
+            self.open_segment()     # Reconfigured since the segment was started
+
+        self.record['timestamp'] = timestamp
+
+        for stage in self.stages:
+
+            spectrum = getattr(self.ram_ft, 'frequency_spectrum_' + stage['name'])
+            if len(spectrum) != stage['width']:
+                spectrum = np.interp(np.linspace(0, len(spectrum) - 1, stage['width']), np.arange(len(spectrum)), spectrum)
+
+            if stage['dtype'] == 'float32':
+                self.record[stage['name']][0] = spectrum
+            else:
+                low, high = stage['scale']
+                normalized = np.clip((np.asarray(spectrum) - low) / (high - low), 0, 1)
+                self.record[stage['name']][0] = np.round(normalized * quantized_max[stage['dtype']])
+
+        indexed = self.segment_frames % self.index_interval == 0
+        if indexed:
+            self.index_file.write(np.array([(timestamp, self.segment_frames)], dtype=index_dtype).tobytes())
+
+        self.file.write(self.record.tobytes())
+        self.segment_frames += 1
+        self.frames_written += 1
+
+        if indexed:
+            self.flush()    # So at most index_interval frames are lost if the process dies without close()
+
+    def flush(self):
+
+        self.file.flush()
+        self.index_file.flush()
+
+    def close(self):
+
+        self.file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+class SpectrumLog (object):
+
+    """
+    SpectrumLog maps a log written by SpectrumLogWriter. Nothing is read until it's used:
+
+        spectrum_log = SpectrumLog('session.rfft')
+        spectrum_log.stage('final')             # (frames, width) view of the stored values, no copy
+        spectrum_log.spectrum('final', 1000)    # one frame as float32, dequantized if need be
+        spectrum_log.frame_from_time(t)
+
+    A log that is still being written can be opened; call refresh() to pick up frames appended since.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+
+            if f.read(len(log_magic)) != log_magic:
+                raise ValueError('SpectrumLog.__init__: ' + str(path) + ' is not a spectrum log')
+
+            header_length = struct.unpack('<I', f.read(4))[0]
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        self.config = header['config']
+        self.stages = {stage['name']: stage for stage in header['stages']}
+        self.index_interval = header['index_interval']
+        self.dtype = record_dtype(header['stages'])
+
+        if self.dtype.itemsize != header['record_size']:
+            raise ValueError('SpectrumLog.__init__: record size ' + str(header['record_size']) + ' in ' + str(path) +
+                             ' does not match its stages')
+
+        preamble_length = len(log_magic) + 4 + header_length
+        self.data_offset = preamble_length + (-preamble_length % log_alignment)
+
+        self.refresh()
+
+    def refresh(self):
+
+        # A record that is only partly written yet is left out
+        self.frames = max(0, (os.path.getsize(self.path) - self.data_offset) // self.dtype.itemsize)
+        self.records = (np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.data_offset, shape=(self.frames,))
+                        if self.frames > 0 else np.zeros(0, dtype=self.dtype))
+
+        index_path = self.path + '.idx'
+        index_entries = os.path.getsize(index_path) // index_dtype.itemsize if os.path.exists(index_path) else 0
+        self.index = (np.memmap(index_path, dtype=index_dtype, mode='r', shape=(index_entries,))
+                      if index_entries > 0 else np.zeros(0, dtype=index_dtype))
+
+    def __len__(self):
+
+        return self.frames
+
+    @property
+    def timestamps(self):
+
+        return self.records['timestamp']
+
+    def stage(self, name):
+        """ Zero-copy (frames, width) view of one stage, as stored """
+
+        return self.records[name]
+
+    def spectrum(self, name, frame):
+        """ One frame of one stage as float32. Zero-copy for float32 logs """
+
+        values = self.records[name][frame]
+        stage = self.stages[name]
+        if stage['dtype'] == 'float32':
+            return values
+
+        low, high = stage['scale']
+        return (values.astype('float32') / quantized_max[stage['dtype']]) * (high - low) + low
+
+    def frame_from_time(self, timestamp):
+        """ Number of the newest frame logged at or before timestamp (0 if all frames are newer) """
+
+        if self.frames == 0:
+            raise IndexError('SpectrumLog.frame_from_time: log is empty')
+
+        # Narrow down with the sparse index first so that only one stretch of records gets paged in
+        low, high = 0, self.frames
+        indexed = self.index[self.index['frame'] < self.frames]
+        if len(indexed) > 0:
+            entry = int(np.searchsorted(indexed['timestamp'], timestamp, side='right')) - 1
+            if entry >= 0:
+                low = int(indexed['frame'][entry])
+            if entry + 1 < len(indexed):
+                high = int(indexed['frame'][entry + 1])
+
+        frame = low + int(np.searchsorted(self.timestamps[low:high], timestamp, side='right')) - 1
+        return max(frame, 0)
+
+class SpectrumReplay (object):
+
+    """
+    SpectrumReplay plays a spectrum log back through a RammiFFT built from the logged config, so anything that draws a
+    RammiFFT (fft_console.py, most_basic_visualizer.py) can draw a recorded session instead:
+
+        replay = SpectrumReplay('session.rfft', speed=4)
+        ram_ft = replay.ram_ft
+        ...
+        replay.update()
+        somehow_display(ram_ft.frequency_spectrum_final)
+
+    Logged stages are swapped into ram_ft as they were at the matching point in the session; time domain buffers and
+    stages that weren't logged stay at zero. speed scales playback, e.g. 0.5 for half speed.
+
+    All segments of the log are played in order. Crossing into a segment with a different config reconfigures ram_ft
+    in place, so references to it held by the caller stay valid. self.log is the segment being played, self.segment its
+    number and self.frame the frame within it.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False):
+
+        self.logs = [log for log in (SpectrumLog(p) for p in segment_paths(path)) if len(log) > 0]
+        if len(self.logs) == 0:
+            raise ValueError('SpectrumReplay.__init__: ' + str(path) + ' has no frames')
+
+        self.log = self.logs[0]
+        self.segment_starts = [log.timestamps[0] for log in self.logs]
+
+        self.ram_ft = RammiFFT(**self.log.config)
+        self.speed = speed
+        self.loop = loop
+
+        self.start_time = None
+        self.segment = None
+        self.frame = None
+        self.finished = False
+
+    def start(self, now=None):
+
+        self.start_time = time.time() if now is None else now
+        self.segment = None
+        self.frame = None
+        self.finished = False
+
+    def session_time(self, now=None):
+        """ The point in the logged session that corresponds to now """
+
+        if now is None:
+            now = time.time()
+        if self.start_time is None:
+            self.start(now)
+
+        first = self.segment_starts[0]
+        elapsed = (now - self.start_time) * self.speed
+        duration = self.logs[-1].timestamps[-1] - first
+
+        if elapsed > duration:
+            if self.loop and duration > 0:
+                elapsed %= duration
+            else:
+                self.finished = True
+                elapsed = duration
+
+        return first + elapsed
+
+    def use_segment(self, log):
+
+        if log.config != self.log.config:
+            self.ram_ft.reconfigure(avg_per_oct=log.config['avg_per_oct'], ref_ratio=log.config['ref_ratio'],
+                                    trim_ratio=log.config['trim_ratio'], beautified_size=log.config['beautified_size'])
+        self.log = log
+
+    def update(self, now=None):
+        """ Load the frame due at now into ram_ft. Returns True if it's a different frame than last time """
+
+        timestamp = self.session_time(now)
+        segment = max(0, int(np.searchsorted(self.segment_starts, timestamp, side='right')) - 1)
+        log = self.logs[segment]
+
+        frame = log.frame_from_time(timestamp)
+        if segment == self.segment and frame == self.frame:
+            return False
+
+        self.use_segment(log)
+
+        self.segment = segment
+        self.frame = frame
+        for name in log.stages:
+            spectrum = log.spectrum(name, frame)
+            setattr(self.ram_ft, 'frequency_spectrum_' + name, spectrum)
+            if name == 'final':
+                self.ram_ft.frequency_spectrum_interpolated = spectrum
+            elif name == 'interpolated':
+                self.ram_ft.frequency_spectrum_final = spectrum
+
+        return True